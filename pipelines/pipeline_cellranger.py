@@ -36,7 +36,7 @@ Overview
 This pipeline performs the following functions:
 
 * Alignment and quantitation (using cellranger count)
-* QC of aligned reads (picard MarkDuplicates)
+* QC of aligned reads (samtools markdup, single-end 10x BAM files only)
 * Sample aggregation (cellranger aggr)
 * Cleaning of aggregated matrices to exclude potential barcode hopping events
 * Random down-sampling and arbitrary sub-setting of aggregated count matrices
@@ -102,7 +102,7 @@ Dependencies
 This pipeline requires:
 * cgat-core: https://github.com/cgat-developers/cgat-core
 * cellranger: https://support.10xgenomics.com/single-cell-gene-expression/
-* picard tools (optional): https://broadinstitute.github.io/picard/
+* samtools (>=1.16, optional): http://www.htslib.org/
 * R & various packages.
 
 
@@ -125,13 +125,20 @@ from ruffus import *
 from pathlib import Path
 import sys
 import os
-import glob
-import sqlite3
+import re
+import functools
+import heapq
+import shutil
+import subprocess
 import cgatcore.experiment as E
 from cgatcore import pipeline as P
 import cgatcore.iotools as IOTools
+import numpy as np
 import pandas as pd
 
+# import local pipeline utility functions
+from pipeline_utils import tables
+
 # -------------------------- < parse parameters > --------------------------- #
 
 # load options from the config file
@@ -160,12 +167,48 @@ if len(sys.argv) > 1:
 # ########################################################################### #
 
 
+# <name_field_titles>.<ncells>.<seq_batch>.sample
+SAMPLE_RE = re.compile(
+    r"^(?P<name>[^.]+)\.(?P<ncells>\d+)\.(?P<seq_batch>\d+)\.sample$")
+
+# Parsed sample information, keyed on (check_only, mtime of data.dir,
+# name_field_titles, sample_fields)
+_SAMPLE_INFO_CACHE = {}
+
+
 def sample_information(check_only=True):
     '''Check the input samples.
 
        The sample table is returned as a pandas data frame.
+
+       Results are cached in memory for the current process. The cache
+       is invalidated when the contents of data.dir or the sample name
+       parameters change.
+    '''
+    key = (check_only, os.path.getmtime("data.dir"),
+           PARAMS["name_field_titles"], PARAMS["sample_fields"])
+
+    if key not in _SAMPLE_INFO_CACHE:
+        _SAMPLE_INFO_CACHE[key] = parse_sample_information(check_only)
+
+    sample_table = _SAMPLE_INFO_CACHE[key]
+
+    if sample_table is not None:
+        sample_table = sample_table.copy()
+
+    return sample_table
+
+
+def parse_sample_information(check_only=True):
+    '''Parse the names of the .sample files in data.dir.
+
+       See sample_information().
     '''
-    sample_files = glob.glob(os.path.join("data.dir", "*.sample"))
+    # (as the glob "*.sample", hidden files are ignored)
+    with os.scandir("data.dir") as entries:
+        sample_files = [x.path for x in entries
+                        if x.name.endswith(".sample") and
+                        not x.name.startswith(".") and x.is_file()]
 
     # Check we have input
     if len(sample_files) == 0:
@@ -173,62 +216,61 @@ def sample_information(check_only=True):
 
     # User-defined titles for '_'-separated metadata encoded in file name
     name_field_titles = PARAMS["name_field_titles"].split(",")
-    # Add required '.'-separated metadata fields encoded in file name
-    sample_titles = name_field_titles + ["ncells", "seq_id", "file"]
-
-    samples = {}
 
     # Process file names
-    for sample_file in sample_files:
-        # We expect 4 '.'-delimited sections to the sample filename:
-        # <name_field_titles>.<ncells>.<seq_batch>.sample
-        sample_basename = os.path.basename(sample_file)
-        sample_name_sections = sample_basename.split(".")
-        if len(sample_name_sections) != 4:
-            raise ValueError(
-                "%(sample_basename)s does not have the expected"
-                " number of dot-separated sections. Format expected is:"
-                " sample_name_fields.ncells.seq_batch.sample, e.g. "
-                " donor1_stim_R1.2000.1.sample " % locals())
-        # The first field encodes '_'-delimited metadata for each sample
-        sample_name = sample_name_sections[0]
-        if "sample_id" in sample_name:
-            raise ValueError('The sample names cannot contain "sample_id"')
-
-        if len(sample_name.split("_")) != len(name_field_titles):
-            raise ValueError(
-                "%(sample_name)s does not have the expected"
-                " number of name fields (%(name_field_titles)s)."
-                " Note that name fields must be separated with"
-                " underscores" % locals())
-
-        # Combine the metadata as a list
-        sample_fields = sample_name.split("_") + \
-            sample_name_sections[1:3] + [sample_file]
-
-        # Add the list of metadata to the dictionary of samples
-        # under the appropriate key
-        samples[sample_name] = dict(zip(sample_titles, sample_fields))
+    sample_basenames = pd.Series([os.path.basename(x) for x in sample_files])
+
+    # We expect 4 '.'-delimited sections to the sample filename:
+    # <name_field_titles>.<ncells>.<seq_batch>.sample
+    sample_name_sections = sample_basenames.str.extract(SAMPLE_RE)
+
+    bad_sections = sample_basenames[sample_name_sections["name"].isnull()]
+    if len(bad_sections) > 0:
+        raise ValueError(
+            "%s does not have the expected"
+            " dot-separated sections. Format expected is:"
+            " sample_name_fields.ncells.seq_batch.sample, where ncells"
+            " and seq_batch are integers, e.g. "
+            " donor1_stim_R1.2000.1.sample " % bad_sections.iloc[0])
+
+    # The first field encodes '_'-delimited metadata for each sample
+    sample_names = sample_name_sections["name"]
+    if sample_names.str.contains("sample_id", regex=False).any():
+        raise ValueError('The sample names cannot contain "sample_id"')
+
+    bad_names = sample_names[
+        sample_names.str.count("_") + 1 != len(name_field_titles)]
+    if len(bad_names) > 0:
+        raise ValueError(
+            "%s does not have the expected"
+            " number of name fields (%s)."
+            " Note that name fields must be separated with"
+            " underscores" % (bad_names.iloc[0], name_field_titles))
 
     if check_only:
         return
 
-    sample_table = pd.DataFrame(samples).transpose()
-    sample_table["library_id"] = sample_table.index
+    # Combine the metadata in a table indexed by sample name
+    sample_table = sample_names.str.split("_", expand=True)
+    sample_table.columns = name_field_titles
+    sample_table["ncells"] = sample_name_sections["ncells"]
+    sample_table["seq_id"] = sample_name_sections["seq_batch"]
+    sample_table["file"] = sample_files
+    sample_table["library_id"] = sample_names
+
+    sample_table.set_index("library_id", drop=False, inplace=True)
 
     if PARAMS["sample_fields"] is None:
         sample_table["sample_id"] = sample_table["library_id"]
     else:
         sample_fields = PARAMS["sample_fields"].split(",")
-        sample_table["sample_id"] = ["_".join([str(y) for y in x])
-                                     for x in
-                                     sample_table[sample_fields].values]
+        sample_table["sample_id"] = sample_table[sample_fields].astype(
+            str).agg("_".join, axis=1)
 
-    sample_table["molecule_h5"] = [x + "-count/outs/molecule_info.h5"
-                                   for x in sample_table["library_id"].values]
+    sample_table["molecule_h5"] = (sample_table["library_id"].astype(str) +
+                                   "-count/outs/molecule_info.h5")
 
-    sample_table["agg_id"] = [str(x) for x in
-                              list(range(1, len(sample_table.index)+1))]
+    sample_table["agg_id"] = np.arange(1, len(sample_table) + 1).astype(str)
 
     return sample_table
 
@@ -274,26 +316,19 @@ def cellrangerCount(infile, outfile):
     # parse the sample name and expected cell number
     library_id, cellnumber, batch, trash = os.path.basename(infile).split(".")
 
-    # build lists of the sample files
-    seq_folders = []
-    sample_ids = []
-
-    # Parse the list of sequencing runs (i.e., paths) for the sample
+    # Parse the list of sequencing runs (i.e., paths) for the sample,
+    # ignoring blank lines
     with open(infile, "r") as sample_list:
-        for line in sample_list:
-            seq_folder_path = line.strip()
-            if seq_folder_path != "":
-                seq_folders.append(seq_folder_path)
-                sample_ids.append(os.path.basename(seq_folder_path))
+        seq_folders = [x.strip() for x in sample_list if x.strip()]
 
     input_fastqs = ",".join(seq_folders)
-    input_samples = ",".join(sample_ids)
+    input_samples = ",".join(os.path.basename(x) for x in seq_folders)
 
     id_tag = library_id + "-count"
 
     log_file = id_tag + ".log"
 
-    ## send one job script to slurm queue which arranges cellranger run
+    ## send one job script to the queue which arranges cellranger run
     ## hard-coded to ensure enough resources
     job_threads = 6
     job_memory = "24000M"
@@ -305,7 +340,7 @@ def cellrangerCount(infile, outfile):
                    --transcriptome %(transcriptome)s
                    --expect-cells %(cellnumber)s
                    --chemistry %(cellranger_chemistry)s
-                   --jobmode=slurm
+                   --jobmode=%(cellranger_jobmode)s
                    --maxjobs=%(max_jobs)s
                    --nopreflight
             &> %(log_file)s
@@ -334,17 +369,11 @@ def reformatCellrangerCountMetrics(infile, outfile):
     data.columns = [x.replace(" ", "_") for x in data.columns]
 
     # deal with percentages
-    new_col_names = []
-    for col in data.columns:
-        tmp = data.ix[0][col]
-        if isinstance(tmp, str):
-            if tmp.endswith("%"):
-                new_col_names.append(col + "_pct")
-                data.set_value(0, col, tmp[:-1])
-        else:
-            new_col_names.append(col)
+    text = data.select_dtypes(include="object")
+    pct_cols = text.columns[text.iloc[0].astype(str).str.endswith("%")]
 
-    data.columns = new_col_names
+    data[pct_cols] = data[pct_cols].apply(lambda x: x.str.rstrip("%"))
+    data.rename(columns={x: x + "_pct" for x in pct_cols}, inplace=True)
 
     data.to_csv(outfile, sep="\t", index=False)
 
@@ -357,12 +386,10 @@ def loadCellrangerCountMetrics(infiles, outfile):
     load the summary statistics for each run into a csvdb file
     '''
 
-    P.concatenate_and_load(
+    tables.load_tsvs_to_sqlite(
         infiles, outfile,
         regex_filename="(.*)-count/.*.txt",
-        has_titles=True,
-        options="",
-        cat="sample")
+        table=P.snip(outfile, ".load"))
 
 
 @active_if(PARAMS["input"] == "mkfastq")
@@ -377,9 +404,11 @@ def rawQcMetricsPerBarcode(infile, outfile):
 
     transcriptome = PARAMS["cellranger_transcriptome"]
 
+    library_id = os.path.dirname(outfile)[:-len("-count")]
+
     # Build the path to the raw UMI count matrix
-    #genome = os.path.basename(transcriptome).split("-")[2]
-    matrixpath = os.path.join(os.path.dirname(outfile), "outs", "raw_feature_bc_matrix")
+    matrixh5 = os.path.join(os.path.dirname(outfile), "outs",
+                            "raw_feature_bc_matrix.h5")
 
     # Build the path to the GTF file used by CellRanger
     gtf = os.path.join(transcriptome, "genes", "genes.gtf")
@@ -387,9 +416,10 @@ def rawQcMetricsPerBarcode(infile, outfile):
     # Build the path to the log file
     log_file = P.snip(outfile, ".txt") + ".log"
 
-    statement = '''Rscript %(tenx_dir)s/R/cellranger_rawQcMetrics.R
-                   --matrixpath=%(matrixpath)s
+    statement = '''python %(tenx_dir)s/python/raw_qc_metrics.py
+                   --matrixh5=%(matrixh5)s
                    --gtf=%(gtf)s
+                   --sample=%(library_id)s
                    --outfile=%(outfile)s
                    &> %(log_file)s
                 '''
@@ -405,142 +435,430 @@ def loadRawQcMetricsPerBarcode(infiles, outfile):
     load the total UMI and barcode rank into a sqlite database
     '''
 
-    P.concatenate_and_load(
+    # the sample column is written by rawQcMetricsPerBarcode
+    tables.load_tsvs_to_sqlite(
         infiles, outfile,
         regex_filename="(.*)-count/.*.txt",
-        has_titles=True,
-        options="",
-        cat="sample")
+        table=P.snip(outfile, ".load"),
+        cat=None)
 
 
 @active_if(PARAMS["input"] == "mkfastq")
 @follows(mkdir("qc.dir"))
 @transform(loadRawQcMetricsPerBarcode,
        regex(r"(.*).load"),
-       r"qc.dir/\1.umi_rank.pdf")
-def plotUmiRankPerBarcodePerSample(infile, outfile):
+       [r"qc.dir/\1.umi_rank.pdf",
+        r"qc.dir/\1.umi_frequency.pdf",
+        r"qc.dir/\1.umi_mitochondrial.pdf"])
+def plotUmiAll(infile, outfiles):
     '''
     plot the total UMI and barcode for all samples in the experiment
+
+    The independent plotting scripts are run concurrently.
     '''
 
     tablename = P.snip(infile, ".load")
 
-    # Build the path to the log file
-    log_file = P.snip(outfile, ".pdf") + ".log"
+    tenx_dir = PARAMS["tenx_dir"]
 
-    statement = '''Rscript %(tenx_dir)s/R/cellranger_plotUmiRank.R
-                   --tablename=%(tablename)s
-                   --outfile=%(outfile)s
-                   &> %(log_file)s
-                '''
+    scripts = ["cellranger_plotUmiRank.R",
+               "cellranger_PlotUmiFrequency.R",
+               "cellranger_plotUmiMitochondrial.R"]
 
-    P.run(statement)
+    statements = []
+
+    for script, outfile in zip(scripts, outfiles):
+
+        # Build the path to the log file
+        log_file = P.snip(outfile, ".pdf") + ".log"
+
+        statement = '''Rscript %(tenx_dir)s/R/%(script)s
+                       --tablename=%(tablename)s
+                       --outfile=%(outfile)s
+                       &> %(log_file)s
+                    ''' % locals()
+
+        statements.append(statement)
+
+    P.run(statements)
 
 
 @active_if(PARAMS["input"] == "mkfastq")
-@follows(mkdir("qc.dir"))
+@follows(plotUmiAll)
 @transform(loadRawQcMetricsPerBarcode,
        regex(r"(.*).load"),
-       r"qc.dir/\1.umi_frequency.pdf")
-def plotUmiFrequencyPerSample(infile, outfile):
+       r"qc.dir/\1.umi_rank.pdf")
+def plotUmiRankPerBarcodePerSample(infile, outfile):
     '''
     plot the total UMI and barcode for all samples in the experiment
+    (the plot is made by plotUmiAll)
     '''
 
-    tablename = P.snip(infile, ".load")
+    IOTools.touch_file(outfile)
 
-    # Build the path to the log file
-    log_file = P.snip(outfile, ".pdf") + ".log"
 
-    statement = '''Rscript %(tenx_dir)s/R/cellranger_PlotUmiFrequency.R
-                   --tablename=%(tablename)s
-                   --outfile=%(outfile)s
-                   &> %(log_file)s
-                '''
+@active_if(PARAMS["input"] == "mkfastq")
+@follows(plotUmiAll)
+@transform(loadRawQcMetricsPerBarcode,
+       regex(r"(.*).load"),
+       r"qc.dir/\1.umi_frequency.pdf")
+def plotUmiFrequencyPerSample(infile, outfile):
+    '''
+    plot the total UMI and barcode for all samples in the experiment
+    (the plot is made by plotUmiAll)
+    '''
 
-    P.run(statement)
+    IOTools.touch_file(outfile)
 
 
 @active_if(PARAMS["input"] == "mkfastq")
-@follows(mkdir("qc.dir"))
+@follows(plotUmiAll)
 @transform(loadRawQcMetricsPerBarcode,
        regex(r"(.*).load"),
        r"qc.dir/\1.umi_mitochondrial.pdf")
 def plotUmiMitochondrialPerSample(infile, outfile):
     '''
     plot the total UMI and barcode for all samples in the experiment
+    (the plot is made by plotUmiAll)
     '''
 
-    tablename = P.snip(infile, ".load")
+    IOTools.touch_file(outfile)
 
-    # Build the path to the log file
-    log_file = P.snip(outfile, ".pdf") + ".log"
 
-    statement = '''Rscript %(tenx_dir)s/R/cellranger_plotUmiMitochondrial.R
-                   --tablename=%(tablename)s
-                   --outfile=%(outfile)s
-                   &> %(log_file)s
-                '''
+# ########################################################################### #
+# ############## calculate duplication metrics (samtools) ################### #
+# ########################################################################### #
+
+@functools.lru_cache(maxsize=None)
+def _picard_resources():
+    '''Return the threads and the memory per thread for the
+       duplication metrics jobs.'''
+
+    threads = PARAMS["picard_threads"]
+    memory = str(
+        int(PARAMS["picard_total_mb_memory"]) // int(threads)
+        ) + "M"
+
+    return threads, memory
+
+
+@active_if(PARAMS["input"] == "mkfastq")
+@transform(cellrangerCount,
+           regex(r"(.*)-count/cellranger.count.sentinel"),
+           r"\1-count/outs/possorted_genome_bam.bam.bai")
+def indexCellrangerBam(infile, outfile):
+    '''
+    Index the cellranger BAM file once for use by the downstream tasks.
+
+    The index written by cellranger count is reused if it is up to date.
+    '''
+
+    bam = P.snip(outfile, ".bai")
+
+    if os.path.exists(outfile) and \
+       os.path.getmtime(outfile) >= os.path.getmtime(bam):
+        IOTools.touch_file(outfile)
+        return
+
+    job_threads, job_memory = _picard_resources()
+
+    statement = '''samtools index -@ %(job_threads)s %(bam)s %(outfile)s'''
 
     P.run(statement)
 
 
-# ########################################################################### #
-# ############## calculate duplication metrics (picard) ##################### #
-# ########################################################################### #
+# Awk program reformatting `samtools markdup` statistics to the
+# Picard MarkDuplicates metric columns. The samtools "EXCLUDED" count
+# mixes unmapped, QC-fail, secondary and supplementary reads, so the
+# secondary/supplementary and unmapped counts are passed in separately.
+MARKDUP_METRICS_AWK = '''awk -F": " -v OFS="\\t" -v library=%(library_id)s
+                       -v secondary=${secondary} -v unmapped=%(unmapped)s
+                   '{stats[$1] = $2}
+                    END {
+                      print "LIBRARY", "UNPAIRED_READS_EXAMINED",
+                            "READ_PAIRS_EXAMINED",
+                            "SECONDARY_OR_SUPPLEMENTARY_RDS",
+                            "UNMAPPED_READS",
+                            "UNPAIRED_READ_DUPLICATES",
+                            "READ_PAIR_DUPLICATES",
+                            "READ_PAIR_OPTICAL_DUPLICATES",
+                            "PERCENT_DUPLICATION",
+                            "ESTIMATED_LIBRARY_SIZE";
+                      examined = stats["SINGLE"] + stats["PAIRED"];
+                      duplicates = stats["DUPLICATE SINGLE"] +
+                                   stats["DUPLICATE PAIR"];
+                      print library, stats["SINGLE"] + 0,
+                            stats["PAIRED"] / 2,
+                            secondary + 0,
+                            unmapped + 0,
+                            stats["DUPLICATE SINGLE"] + 0,
+                            stats["DUPLICATE PAIR"] / 2,
+                            stats["DUPLICATE PAIR OPTICAL"] / 2,
+                            (examined > 0 ? duplicates / examined : 0),
+                            stats["ESTIMATED_LIBRARY_SIZE"] + 0}'
+                '''
+
+
+def bam_contigs(bam):
+    '''Return the contigs with mapped reads in an indexed BAM file
+       as a list of (contig, mapped reads, placed unmapped reads) in
+       the order of the BAM header, and the number of unplaced
+       unmapped reads.
+    '''
+    idxstats = subprocess.check_output(["samtools", "idxstats", bam],
+                                       universal_newlines=True)
+
+    contigs = []
+    unplaced = 0
+    for line in idxstats.strip().split("\n"):
+        contig, length, mapped, unmapped = line.split("\t")
+        if contig == "*":
+            unplaced = int(unmapped)
+        elif int(mapped) > 0:
+            contigs.append((contig, int(mapped), int(unmapped)))
+
+    return contigs, unplaced
+
+
+def bam_is_paired(bam, n_reads=10000):
+    '''Return True if any of the first n_reads reads of a BAM file
+       is flagged as paired (0x1).
+    '''
+    view = subprocess.Popen(["samtools", "view", bam],
+                            stdout=subprocess.PIPE,
+                            universal_newlines=True)
+    paired = False
+    for i, line in enumerate(view.stdout):
+        if int(line.split("\t", 2)[1]) & 1:
+            paired = True
+        if paired or i + 1 >= n_reads:
+            break
+
+    view.kill()
+    view.wait()
+
+    return paired
+
+
+def shard_contigs(contigs, n_shards):
+    '''Group the contigs (see bam_contigs) into at most n_shards
+       shards with balanced numbers of mapped reads.
+
+       Each shard is returned as a list of contigs in the order of
+       the BAM header, as required by samtools markdup.
+    '''
+    heap = [(0, i, []) for i in range(min(n_shards, len(contigs)))]
+
+    # assign the largest contigs first, each to the smallest shard
+    for order, (contig, mapped, unmapped) in sorted(
+            enumerate(contigs), key=lambda x: -x[1][1]):
+        reads, i, shard = heapq.heappop(heap)
+        shard.append((order, contig, mapped, unmapped))
+        heapq.heappush(heap, (reads + mapped, i, shard))
+
+    return [[x[1:] for x in sorted(shard)] for reads, i, shard in heap]
+
+
+# The columns of the duplication metrics table
+DUPLICATION_METRICS_COLUMNS = ["LIBRARY", "UNPAIRED_READS_EXAMINED",
+                               "READ_PAIRS_EXAMINED",
+                               "SECONDARY_OR_SUPPLEMENTARY_RDS",
+                               "UNMAPPED_READS",
+                               "UNPAIRED_READ_DUPLICATES",
+                               "READ_PAIR_DUPLICATES",
+                               "READ_PAIR_OPTICAL_DUPLICATES",
+                               "PERCENT_DUPLICATION",
+                               "ESTIMATED_LIBRARY_SIZE"]
+
+
+def estimate_library_size(read_pairs, unique_read_pairs):
+    '''Estimate the library size with the Lander-Waterman equation
+       as Picard MarkDuplicates does, i.e. solve
+
+           unique / x - 1 + exp(-pairs / x) = 0
+
+       by bisection. Return NaN if the size cannot be estimated
+       (no read pairs or no duplicate pairs).
+    '''
+    def f(x, c, n):
+        return c / x - 1 + np.exp(-n / x)
+
+    if read_pairs <= 0 or unique_read_pairs >= read_pairs or \
+       f(unique_read_pairs, unique_read_pairs, read_pairs) < 0:
+        return np.nan
+
+    lower, upper = 1.0, 100.0
+
+    while f(upper * unique_read_pairs, unique_read_pairs, read_pairs) > 0:
+        upper *= 10.0
+
+    for i in range(40):
+        r = (lower + upper) / 2.0
+        u = f(r * unique_read_pairs, unique_read_pairs, read_pairs)
+        if u == 0:
+            break
+        elif u > 0:
+            lower = r
+        else:
+            upper = r
 
-PICARD_THREADS = PARAMS["picard_threads"]
-PICARD_MEMORY = str(
-    int(PARAMS["picard_total_mb_memory"]) // int(PICARD_THREADS)
-    ) + "M"
+    return int(unique_read_pairs * (lower + upper) / 2.0)
+
+
+def merge_duplication_metrics(infiles, outfile, library_id,
+                              unplaced_unmapped=0):
+    '''Combine per-shard duplication metrics into a single table.
+
+       Counts are summed across the shards. The duplication rate and
+       the library size (which is not additive) are recomputed from the
+       totals. The unmapped reads that are not placed on any contig are
+       added to UNMAPPED_READS. If there are no contigs, a row of zero
+       counts is written.
+    '''
+    counts = [x for x in DUPLICATION_METRICS_COLUMNS
+              if x not in ["LIBRARY", "PERCENT_DUPLICATION",
+                           "ESTIMATED_LIBRARY_SIZE"]]
+
+    if len(infiles) > 0:
+        shards = pd.concat([pd.read_csv(x, sep="\t") for x in infiles])
+        metrics = shards[counts].sum().to_frame().transpose()
+    else:
+        metrics = pd.DataFrame(0, index=[0], columns=counts)
+
+    metrics["UNMAPPED_READS"] += unplaced_unmapped
+
+    examined = (metrics["UNPAIRED_READS_EXAMINED"] +
+                2 * metrics["READ_PAIRS_EXAMINED"])
+    duplicates = (metrics["UNPAIRED_READ_DUPLICATES"] +
+                  2 * metrics["READ_PAIR_DUPLICATES"])
+
+    metrics["PERCENT_DUPLICATION"] = (duplicates / examined).fillna(0)
+
+    # as Picard, optical duplicates are excluded from the read pairs
+    read_pairs = (metrics["READ_PAIRS_EXAMINED"] -
+                  metrics["READ_PAIR_OPTICAL_DUPLICATES"]).iloc[0]
+    unique_read_pairs = (metrics["READ_PAIRS_EXAMINED"] -
+                         metrics["READ_PAIR_DUPLICATES"]).iloc[0]
+
+    metrics["ESTIMATED_LIBRARY_SIZE"] = estimate_library_size(
+        read_pairs, unique_read_pairs)
+
+    metrics["LIBRARY"] = library_id
+
+    metrics = metrics[DUPLICATION_METRICS_COLUMNS]
+
+    metrics.to_csv(outfile, sep="\t", index=False)
 
 
 @active_if(PARAMS["input"] == "mkfastq")
+@follows(indexCellrangerBam)
 @transform(cellrangerCount,
            regex(r"(.*)-count/cellranger.count.sentinel"),
            r"\1-count/picard_duplication_metrics.txt")
 def picardMarkDuplicates(infile, outfile):
     '''
-    Yield duplication metrics using Picard Tools.
+    Yield duplication metrics using samtools markdup.
+
+    Duplicates are marked in a barcode-aware manner with the
+    samtools implementation. The contigs are grouped into a few
+    shards with balanced read counts, one job is run for each shard
+    and the per-shard metrics are then combined.
+    Only the statistics are kept: the marked reads are discarded.
+    The samtools statistics are reformatted to the Picard
+    MarkDuplicates metric columns so that the downstream database
+    tables are unchanged.
+
+    Only single-end 10x BAM files are supported: samtools markdup
+    requires the MC/ms tags added by `samtools fixmate -m` for paired
+    reads, which cellranger does not write.
     '''
 
-    out_dir = os.path.dirname(outfile)
+    library_id = os.path.dirname(outfile)[:-len("-count")]
 
     bam_in = os.path.join(os.path.dirname(outfile),
                           "outs/possorted_genome_bam.bam")
 
-    base_bam = 'marked_duplicates.bam'
-    base_metrics = os.path.basename(outfile)
+    shard_dir = P.snip(outfile, ".txt") + ".shards.dir"
+    if not os.path.exists(shard_dir):
+        os.mkdir(shard_dir)
 
-    picard_options = PARAMS["picard_markduplicate_options"]
-    barcode_tag = PARAMS["picard_barcode_tag"]
-    read_one_barcode_tag = PARAMS["picard_read_one_barcode_tag"]
-    read_two_barcode_tag = PARAMS["picard_read_two_barcode_tag"]
-    validation_stringency = PARAMS["picard_validation_stringency"]
+    if bam_is_paired(bam_in):
+        raise ValueError(
+            "%s contains paired reads: the duplication metrics (samtools"
+            " markdup) only support single-end 10x BAM files" % bam_in)
 
-    job_threads = PICARD_THREADS
-    job_memory = PICARD_MEMORY
+    barcode_tag = PARAMS["picard_barcode_tag"]
 
     local_tmpdir = P.get_temp_dir()
 
-    statement = '''picard_out=`mktemp -d -p %(local_tmpdir)s`;
-                   MarkDuplicates
-                   I=%(bam_in)s
-                   O=${picard_out}/%(base_bam)s
-                   M=${picard_out}/%(base_metrics)s
-                   BARCODE_TAG=%(barcode_tag)s
-                   READ_ONE_BARCODE_TAG=%(read_one_barcode_tag)s
-                   READ_TWO_BARCODE_TAG=%(read_two_barcode_tag)s
-                   VALIDATION_STRINGENCY=%(validation_stringency)s
-                   %(picard_options)s;
-                   grep . ${picard_out}/%(base_metrics)s
-                   | grep -v "#"
-                   | head -n2
-                   > %(outfile)s;
-                   rm -rv ${picard_out}
-                '''
+    contigs, unplaced_unmapped = bam_contigs(bam_in)
 
-    P.run(statement)
+    shards = shard_contigs(contigs, int(PARAMS["picard_shards"]))
+
+    # The memory is scaled to the largest shard: the small contigs
+    # share shards rather than each being given the whole-BAM request
+    job_threads = PARAMS["picard_threads"]
+
+    total_mapped = sum([x[1] for x in contigs])
+    largest_shard = max([sum([x[1] for x in shard]) for shard in shards] +
+                        [0])
+
+    shard_mb = int(PARAMS["picard_total_mb_memory"])
+    if total_mapped > 0:
+        shard_mb = max(1000, shard_mb * largest_shard // total_mapped)
+
+    job_memory = str(shard_mb // int(job_threads)) + "M"
+
+    statements = []
+    shard_metrics = []
+
+    for i, shard in enumerate(shards):
+
+        # contig names may contain characters unsuitable for file names
+        shard_metrics_file = os.path.join(shard_dir, "shard_%i.txt" % i)
+
+        regions = " ".join(["'%s'" % x[0] for x in shard])
+        unmapped = sum([x[2] for x in shard])
+
+        metrics_awk = MARKDUP_METRICS_AWK % locals()
+
+        # The threads are used to decode the (BGZF) input. The decoded
+        # reads are also counted through a fifo, so that the secondary
+        # and supplementary reads are counted without decoding twice.
+        statement = '''picard_out=`mktemp -d -p %(local_tmpdir)s`;
+                       mkfifo ${picard_out}/reads.fifo;
+                       samtools view -c --rf 0x900
+                         ${picard_out}/reads.fifo
+                         > ${picard_out}/secondary.txt &
+                       samtools view -u
+                         -@ %(job_threads)s
+                         %(bam_in)s %(regions)s
+                       | tee ${picard_out}/reads.fifo
+                       | samtools markdup
+                         --barcode-tag %(barcode_tag)s
+                         -T ${picard_out}/markdup
+                         -f ${picard_out}/stats.txt
+                         --output-fmt bam,level=0
+                         -
+                         /dev/null;
+                       wait;
+                       secondary=`cat ${picard_out}/secondary.txt`;
+                       %(metrics_awk)s
+                       ${picard_out}/stats.txt
+                       > %(shard_metrics_file)s;
+                       rm -rv ${picard_out}
+                    ''' % locals()
+
+        statements.append(statement)
+        shard_metrics.append(shard_metrics_file)
+
+    if len(statements) > 0:
+        P.run(statements)
+
+    merge_duplication_metrics(shard_metrics, outfile, library_id,
+                              unplaced_unmapped=unplaced_unmapped)
+
+    shutil.rmtree(shard_dir)
 
 
 @active_if(PARAMS["input"] == "mkfastq")
@@ -551,12 +869,10 @@ def loadDuplicationMetrics(infiles, outfile):
     Import duplication metrics into project database.
     '''
 
-    P.concatenate_and_load(
+    tables.load_tsvs_to_sqlite(
         infiles, outfile,
         regex_filename="(.*)-count/.*.txt",
-        has_titles=True,
-        options="",
-        cat="sample")
+        table=P.snip(outfile, ".load"))
 
 
 # --------------------- < optional metrics target > ------------------------ #
@@ -656,14 +972,14 @@ def cellrangerAggr(infile, outfile):
 
     log_file = id_tag + ".log"
 
-    ## send one job script to slurm queue which arranges cellranger run
+    ## send one job script to the queue which arranges cellranger run
     ## hard-coded to ensure enough resources
     job_threads = 6
     job_memory = "24000M"
     statement = '''cellranger aggr
                    --id=%(id_tag)s
                    --csv=%(infile)s
-                   --jobmode=slurm
+                   --jobmode=%(cellranger_jobmode)s
                    --normalize=%(aggr_normalize)s
                    %(options)s
                    --maxjobs=%(max_jobs)s
@@ -819,7 +1135,15 @@ def postprocessAggrMatrix(infiles, outfile):
                          ' in file "pipeline.yml"')
 
     tenxdir = os.path.join(agg_dir, mexdir)
-    if not os.path.exists(tenxdir):
+
+    # Prefer the HDF5 matrix (cellranger aggr) over the MEX files (dropEst)
+    tenxh5 = ""
+    if PARAMS["postprocess_tenxh5"] not in (None, "none"):
+        h5_path = os.path.join(agg_dir, PARAMS["postprocess_tenxh5"])
+        if os.path.exists(h5_path):
+            tenxh5 = "--tenxh5=" + h5_path
+
+    if tenxh5 == "" and not os.path.exists(tenxdir):
         raise ValueError('The specified "postprocess_mexdir"'
                          ' directory does not exist in directory ' + agg_dir)
 
@@ -831,6 +1155,7 @@ def postprocessAggrMatrix(infiles, outfile):
 
     statement = '''Rscript %(tenx_dir)s/R/cellranger_postprocessAggrMatrix.R
                    --tenxdir=%(tenxdir)s
+                   %(tenxh5)s
                    --sampletable=%(sample_table)s
                    --samplenamefields=%(name_field_titles)s
                    --downsample=no
@@ -846,6 +1171,11 @@ def postprocessAggrMatrix(infiles, outfile):
     IOTools.touch_file(outfile)
 
 
+# The names of the dataset subsets specified in pipeline.yml
+DATASET_SUBSETS = [k.split("_", 1)[1] for k in PARAMS.keys()
+                   if k.startswith("datasets_")]
+
+
 @transform(postprocessAggrMatrix,
            regex(r"(.*)-processed.dir/postprocess.sentinel"),
            add_inputs(collectSampleInformation),
@@ -864,11 +1194,6 @@ def subsetAndDownsample(infiles, outfile):
     agg_matrix_dir = os.path.join(os.path.dirname(infiles[0]),
                                   "agg.processed.dir")
 
-    sample_table = pd.read_csv(infiles[1], sep="\t")
-
-    subsets = [k.split("_", 1)[1] for k in PARAMS.keys()
-               if k.startswith("datasets_")]
-
     # Titles of fields encoded in filenames
     name_field_titles = PARAMS["name_field_titles"]
 
@@ -883,12 +1208,17 @@ def subsetAndDownsample(infiles, outfile):
 
     statements = []
 
-    for subset in subsets:
+    for subset in DATASET_SUBSETS:
 
         if subset == "all":
             if not PARAMS["datasets_all"]:
                 continue
 
+            if PARAMS["input"] == "mkfastq":
+                sample_table = sample_information(check_only=False)
+            else:
+                sample_table = pd.read_csv(infiles[1], sep="\t")
+
             sample_ids = set(sample_table["sample_id"].values)
             sample_ids_str = ",".join(sample_ids)
 
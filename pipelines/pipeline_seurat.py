@@ -1032,11 +1032,23 @@ def paga(infile, outfile):
 
     k = PARAMS["paga_k"]
 
+    paga_options = ""
+    if PARAMS["paga_emit_random_init_umap"]:
+        paga_options += " --emit_random_init_umap"
+    if PARAMS["paga_use_gpu"]:
+        paga_options += " --use_gpu"
+    if PARAMS["paga_emit_random_init_fdg"]:
+        paga_options += " --emit_random_init_fdg"
+    if PARAMS["run_cellbrowser"]:
+        # the cellbrowser preparation reads the FDG coordinates as text
+        paga_options += " --legacy_tsv"
+
     log_file = outfile.replace("sentinel","log")
 
     # set the job threads and memory
     locals().update(
-        resources.get(memory=PARAMS["resources_memory_standard"]))
+        resources.get(memory=PARAMS["resources_memory_standard"],
+                      cpu=PARAMS["paga_umap_threads"]))
 
     statement = '''python %(tenx_dir)s/python/run_paga.py
                    --reduced_dims_matrix_file=%(reduced_dims_matrix_file)s
@@ -1046,6 +1058,12 @@ def paga(infile, outfile):
                    --cluster_colors=%(cluster_colors)s
                    --comps=%(comps)s
                    --k=%(k)s
+                   --knn_transformer=%(paga_knn_transformer)s
+                   --umap_threads=%(paga_umap_threads)s
+                   --fdg_layout=%(paga_fdg_layout)s
+                   --preview_dpi=%(paga_preview_dpi)s
+                   --final_dpi=%(paga_final_dpi)s
+                   %(paga_options)s
                    &> %(log_file)s
                 '''
 
@@ -1100,11 +1118,18 @@ def phate(infile, outfile):
 
     k = PARAMS["phate_k"]
 
+    phate_options = ""
+    if PARAMS["phate_emit_3d_plot"]:
+        phate_options += " --emit_3d_plot"
+    if PARAMS["phate_legacy_tsv"]:
+        phate_options += " --legacy_tsv"
+
     log_file = outfile.replace("sentinel","log")
 
     # set the job threads and memory
     locals().update(
-        resources.get(memory=PARAMS["resources_memory_standard"]))
+        resources.get(memory=PARAMS["resources_memory_standard"],
+                      cpu=PARAMS["phate_threads"]))
 
     statement = '''python %(tenx_dir)s/python/run_phate.py
                    --data=%(assay_data)s
@@ -1114,7 +1139,10 @@ def phate(infile, outfile):
                    --cluster_assignments=%(cluster_assignments)s
                    --cluster_colors=%(cluster_colors)s
                    --k=%(k)s
+                   --knn_method=%(phate_knn_method)s
+                   --threads=%(phate_threads)s
                    --gif=%(phate_gif)s
+                   %(phate_options)s
                    &> %(log_file)s
                 '''
 
@@ -1367,7 +1395,7 @@ def scvelo(infile, outfile):
 
         pagafdg_table = os.path.join(Path(outdir).parents[0],
                                      "paga.dir",
-                                     "paga_init_fa2.txt.gz")
+                                     "paga_init_fa2.feather")
 
         runs["pagafdg"] = {"method": "paga_fdg",
                            "table": pagafdg_table,
@@ -1377,7 +1405,7 @@ def scvelo(infile, outfile):
 
         phate_table = os.path.join(Path(outdir).parents[0],
                                    "phate.dir",
-                                   "phate.tsv.gz")
+                                   "phate.feather")
 
         runs["phate"] = {"method": "phate",
                          "table": phate_table,
@@ -3066,6 +3094,7 @@ def latexVars(infile, outfile):
             "rdimsVisMethod": "%(rdimsVisMethod)s" % locals() ,
             "velocityDir": "%(velocityDir)s" % locals(),
             "pagaDir": "%(pagaDir)s" % locals(),
+            "pagaFdgLayout": "%(paga_fdg_layout)s" % PARAMS,
             "phateDir": "%(phateDir)s" % locals(),
             "runName": "%(runName)s" % locals(),
             "runDetails": "%(runDetails)s" % locals(),
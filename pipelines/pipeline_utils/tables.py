@@ -0,0 +1,63 @@
+import re
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+
+
+def read_metrics_concurrent(paths, regex_filename="(.*)-count/.*.txt",
+                            cat="sample", max_workers=16):
+    '''read a set of small tab-separated tables using a pool of threads
+       and return them concatenated as a single data frame.
+
+       As for P.concatenate_and_load, the first group matched by
+       regex_filename in each path is added as the column "cat",
+       unless cat is None.'''
+
+    def read_metrics(path):
+        table = pd.read_csv(path, sep="\t")
+        if cat is not None:
+            table.insert(0, cat, re.search(regex_filename, path).group(1))
+        return table
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        tables = list(pool.map(read_metrics, paths))
+
+    return pd.concat(tables, ignore_index=True, sort=False)
+
+
+def load_tsvs_to_sqlite(infiles, outfile, regex_filename, table,
+                        database="csvdb", cat="sample"):
+    '''load a set of tab-separated tables into a single table of
+       an sqlite database.
+
+       The tables are read concurrently (see read_metrics_concurrent)
+       and inserted in a single transaction. Any existing table of the
+       same name is replaced. A short summary is written to outfile.'''
+
+    metrics = read_metrics_concurrent(infiles,
+                                      regex_filename=regex_filename,
+                                      cat=cat)
+
+    sql_types = {"i": "INTEGER", "u": "INTEGER", "b": "INTEGER",
+                 "f": "REAL"}
+
+    columns = ", ".join(['"%s" %s' % (x, sql_types.get(y.kind, "TEXT"))
+                         for x, y in metrics.dtypes.items()])
+    placeholders = ", ".join(["?"] * len(metrics.columns))
+
+    connection = sqlite3.connect(database)
+    connection.execute("PRAGMA synchronous=OFF")
+    connection.execute("PRAGMA journal_mode=MEMORY")
+
+    with connection:
+        connection.execute('DROP TABLE IF EXISTS "%s"' % table)
+        connection.execute('CREATE TABLE "%s" (%s)' % (table, columns))
+        connection.executemany(
+            'INSERT INTO "%s" VALUES (%s)' % (table, placeholders),
+            metrics.itertuples(index=False, name=None))
+
+    connection.close()
+
+    with open(outfile, "w") as summary:
+        summary.write("loaded %i rows into table %s\n" % (len(metrics), table))
@@ -0,0 +1,108 @@
+import re
+import gzip
+import argparse
+import numpy as np
+import pandas as pd
+import h5py
+import logging
+import sys
+
+
+# ########################################################################### #
+# ###################### Set up the logging ################################# #
+# ########################################################################### #
+
+logging.basicConfig(stream=sys.stdout, level=logging.DEBUG)
+L = logging.getLogger("raw_qc_metrics")
+
+
+# ########################################################################### #
+# ######################## Parse the arguments ############################## #
+# ########################################################################### #
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--matrixh5", default="raw_feature_bc_matrix.h5", type=str,
+                    help="The cellranger raw feature-barcode matrix .h5 file")
+parser.add_argument("--gtf", default="genes.gtf", type=str,
+                    help="The GTF file used by cellranger")
+parser.add_argument("--mitochondrial_contig", default="MT", type=str,
+                    help="Name of the mitochondrial contig in the GTF file")
+parser.add_argument("--sample", default="sample", type=str,
+                    help="The sample name written to the output table")
+parser.add_argument("--outfile", default="cellranger.raw.qc.txt", type=str,
+                    help="The output table of per-barcode metrics")
+
+args = parser.parse_args()
+
+
+# ########################################################################### #
+# ################ Identify the mitochondrial genes ######################### #
+# ########################################################################### #
+
+L.info("Reading the mitochondrial genes from " + args.gtf)
+
+if args.gtf.endswith(".gz"):
+    gtf = gzip.open(args.gtf, "rt")
+else:
+    gtf = open(args.gtf, "r")
+
+gene_id = re.compile(r'gene_id "([^"]+)"')
+contig_prefix = args.mitochondrial_contig + "\t"
+
+mt_genes = set()
+with gtf:
+    for line in gtf:
+        if not line.startswith(contig_prefix):
+            continue
+        fields = line.split("\t")
+        if fields[2] == "gene":
+            mt_genes.add(gene_id.search(fields[8]).group(1))
+
+L.info("Found " + str(len(mt_genes)) + " mitochondrial genes")
+
+
+# ########################################################################### #
+# ################ Compute the per-barcode UMI metrics ###################### #
+# ########################################################################### #
+
+# The matrix is stored in compressed sparse column format with one column
+# per barcode: each dataset is read once and the column sums are taken
+# from the cumulative sums of the counts.
+
+L.info("Reading the matrix from " + args.matrixh5)
+
+with h5py.File(args.matrixh5, "r") as h5:
+    matrix = h5["matrix"]
+    data = matrix["data"][:]
+    indices = matrix["indices"][:]
+    indptr = matrix["indptr"][:]
+    feature_ids = matrix["features"]["id"][:].astype(str)
+
+mt_rows = np.flatnonzero(np.isin(feature_ids, list(mt_genes)))
+
+umis_cumsum = np.concatenate([[0], np.cumsum(data, dtype=np.int64)])
+umis = umis_cumsum[indptr[1:]] - umis_cumsum[indptr[:-1]]
+
+mt_data = np.where(np.isin(indices, mt_rows), data, 0)
+mt_cumsum = np.concatenate([[0], np.cumsum(mt_data, dtype=np.int64)])
+umis_mt = mt_cumsum[indptr[1:]] - mt_cumsum[indptr[:-1]]
+
+# Rank the barcodes by total UMIs, ties broken by the barcode order
+rank = np.empty(len(umis), dtype=np.int64)
+rank[np.argsort(-umis, kind="stable")] = np.arange(1, len(umis) + 1)
+
+L.info("Computed metrics for " + str(len(umis)) + " barcodes")
+
+
+# ########################################################################### #
+# ########################## Write the metrics ############################## #
+# ########################################################################### #
+
+metrics = pd.DataFrame({"sample": args.sample,
+                        "umis": umis,
+                        "rank": rank,
+                        "umis_mt": umis_mt})
+
+metrics.to_csv(args.outfile, sep="\t", index=False)
+
+L.info("Complete")
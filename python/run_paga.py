@@ -11,7 +11,12 @@ import matplotlib.pyplot as pl
 import seaborn as sns
 import scanpy as sc
 import pandas as pd
+import pyarrow as pa
+from pyarrow import csv, feather, ipc
 from scipy import sparse
+from packaging import version
+import numba
+from umap.umap_ import find_ab_params, simplicial_set_embedding
 import logging
 import sys
 
@@ -29,6 +34,88 @@ sc.settings.verbosity = 3  # verbosity: errors (0), warnings (1), info (2), hint
 sc.logging.print_versions()
 
 
+# ########################################################################### #
+# ########################### Functions ##################################### #
+# ########################################################################### #
+
+def run_umap(adata, init_pos, threads=1):
+    '''Compute a umap and return the embedding.
+
+       With more than one thread, the layout is optimised in parallel
+       by umap-learn using the scanpy neighbors graph and the scanpy
+       default parameters. The parallel layout is not reproducible.'''
+
+    if threads == 1:
+        sc.tl.umap(adata, init_pos=init_pos)
+
+    else:
+        numba.set_num_threads(threads)
+
+        a, b = find_ab_params(1.0, 0.5)
+
+        # as scanpy: n_epochs=0 would not optimise the layout at all
+        n_epochs = 500 if adata.n_obs <= 10000 else 200
+
+        adata.obsm["X_umap"], _ = simplicial_set_embedding(
+            data=adata.obsm["X_pca"],
+            graph=adata.obsp["connectivities"].tocoo(),
+            n_components=2,
+            initial_alpha=1.0,
+            a=a,
+            b=b,
+            gamma=1.0,
+            negative_sample_rate=5,
+            n_epochs=n_epochs,
+            init=init_pos,
+            random_state=np.random.RandomState(),
+            metric="euclidean",
+            metric_kwds={},
+            densmap=False,
+            densmap_kwds={},
+            output_dens=False,
+            parallel=True)
+
+        adata.uns["umap"] = {"params": {"a": a, "b": b}}
+
+    return adata.obsm["X_umap"]
+
+
+def rapids_available():
+    '''Return True if the RAPIDS cuML library can be imported'''
+
+    try:
+        import cuml
+    except ImportError:
+        L.warning("cuML (RAPIDS) is not available, using the CPU")
+        return False
+
+    return True
+
+
+def get_knn_transformer(method, k, threads=1):
+    '''Return the knn transformer for sc.pp.neighbors,
+       or None for the exact knn'''
+
+    if method == "exact":
+        return None
+
+    if version.parse(sc.__version__) < version.parse("1.10"):
+        L.warning("knn transformers require scanpy >= 1.10,"
+                  " using the exact knn")
+        return None
+
+    if method == "pynndescent":
+        from pynndescent import PyNNDescentTransformer
+        return PyNNDescentTransformer(n_neighbors=k, n_jobs=threads,
+                                      low_memory=False)
+
+    if method == "annoy":
+        from sklearn_ann.kneighbors.annoy import AnnoyTransformer
+        return AnnoyTransformer(n_neighbors=k)
+
+    raise ValueError("knn transformer not recognised: " + method)
+
+
 # ########################################################################### #
 # ######################## Parse the arguments ############################## #
 # ########################################################################### #
@@ -52,6 +139,31 @@ parser.add_argument("--comps", default="1", type=str,
                     help="Number of dimensions to include in knn and umap computation")
 parser.add_argument("--k", default=20, type=int,
                     help="number of neighbors")
+parser.add_argument("--knn_transformer", default="exact", type=str,
+                    choices=["exact", "pynndescent", "annoy"],
+                    help="method used to find the nearest neighbors")
+parser.add_argument("--use_gpu", action="store_true",
+                    help="compute the neighbors on the GPU with RAPIDS cuML")
+parser.add_argument("--umap_threads", default=1, type=int,
+                    help="number of threads used for the approximate knn"
+                         " and to optimise the umap layout")
+parser.add_argument("--emit_random_init_umap", action="store_true",
+                    help="also compute and plot the default (not paga-initialised) umap")
+parser.add_argument("--emit_random_init_fdg", action="store_true",
+                    help="also compute and plot the default (not paga-initialised) FDG")
+parser.add_argument("--fdg_layout", default="fa", type=str,
+                    choices=["fa", "fr", "drl"],
+                    help="FDG layout: ForceAtlas2 (fa) or the igraph"
+                         " Fruchterman-Reingold (fr) or DrL (drl) layouts")
+parser.add_argument("--preview_dpi", default=150, type=int,
+                    help="resolution of the intermediate plots")
+parser.add_argument("--final_dpi", default=300, type=int,
+                    help="resolution of the paga-initialised umap and FDG plots")
+parser.add_argument("--h5ad_compression", default="lzf", type=str,
+                    choices=["lzf", "gzip", "none"],
+                    help="compression of the anndata output file")
+parser.add_argument("--legacy_tsv", action="store_true",
+                    help="also write the coordinates as (gzipped) text tables")
 
 args = parser.parse_args()
 
@@ -73,103 +185,178 @@ results_file = args.outdir + "/" + "paga_anndata.h5ad"
 sc.settings.figdir = args.outdir
 
 # Get the color palette
-ggplot_palette = [x for x in pd.read_csv(args.cluster_colors,
-                      header=None, sep="\t")[0].values]
+ggplot_palette = pd.read_csv(args.cluster_colors,
+                             header=None, sep="\t", usecols=[0],
+                             dtype=str)[0].tolist()
 
 ggplot_cmap = ListedColormap(sns.color_palette(ggplot_palette).as_hex())
 
-sc.settings.set_figure_params(dpi=300, dpi_save=300)
+sc.settings.set_figure_params(dpi=args.preview_dpi, dpi_save=args.preview_dpi)
 
 # ########################################################################### #
 # ############################### Run PAGA ################################## #
 # ########################################################################### #
 
 
-# Read matrix of reduced dimensions, create anndata and add dimensions
-reduced_dims_mat = pd.read_csv(args.reduced_dims_matrix_file, sep="\t")
-reduced_dims_mat.index = [x for x in pd.read_csv(args.barcode_file, header=None)[0]]
+# Read matrix of reduced dimensions, create anndata and add dimensions.
+# A feather copy of the matrix is used if present, otherwise the
+# table is parsed with pyarrow directly as float32. Only the header is
+# read to find the requested components, and only these are parsed.
+feather_file = re.sub(r"\.tsv(\.gz)?$", ".feather",
+                      args.reduced_dims_matrix_file)
 
-adata = sc.AnnData(obs=[x for x in reduced_dims_mat.index])
-adata.obs.index = reduced_dims_mat.index
-adata.obs.rename(columns={0:'barcode'}, inplace=True)
+use_feather = os.path.exists(feather_file)
 
-# Add dimensions to anndata
-colnames = list(reduced_dims_mat.columns)
-colname_prefix = list(set([re.sub(r'_[0-9]+', '', i) for i in colnames]))[0] + "_"
-select_comps = args.comps.split(",")
-select_comps = [ colname_prefix + item for item in select_comps]
-reduced_dims_mat = reduced_dims_mat[select_comps]
+if use_feather:
+    colnames = pd.Index(ipc.open_file(feather_file).schema.names)
+else:
+    colnames = pd.read_csv(args.reduced_dims_matrix_file,
+                           sep="\t", nrows=0).columns
+
+colname_prefix = colnames.str.replace(
+    r'_\d+$', '', regex=True).unique()[0] + "_"
+select_comps = [colname_prefix + item for item in args.comps.split(",")]
+
+if use_feather:
+    L.info("Reading reduced dimensions from " + feather_file)
+    reduced_dims_mat = feather.read_table(
+        feather_file, columns=select_comps).to_pandas().astype(
+        np.float32, copy=False)
+
+else:
+    reduced_dims_mat = csv.read_csv(
+        args.reduced_dims_matrix_file,
+        parse_options=csv.ParseOptions(delimiter="\t"),
+        convert_options=csv.ConvertOptions(
+            include_columns=select_comps,
+            column_types={x: pa.float32() for x in select_comps})).to_pandas()
+
+barcodes = csv.read_csv(
+    args.barcode_file,
+    read_options=csv.ReadOptions(autogenerate_column_names=True)
+    ).column(0).to_numpy()
 
+reduced_dims_mat.index = barcodes
+
+adata = sc.AnnData(X=np.zeros((len(barcodes), 0), dtype=np.float32),
+                   obs=pd.DataFrame({'barcode': barcodes}, index=barcodes))
+
+# Add dimensions to anndata
 L.info("Using comps " + ', '.join(list(reduced_dims_mat.columns)))
 
-adata.obsm['X_pca'] = reduced_dims_mat.to_numpy(dtype="float32")
+# (the matrix is already float32)
+adata.obsm['X_pca'] = reduced_dims_mat.to_numpy()
 
-# Read and add cluster ids
-df = pd.read_csv(args.cluster_assignments,sep="\t")
-df.index = df["barcodes"]
+# Read and add cluster ids. The category dtype is set after parsing
+# so that numeric cluster ids keep their numeric order.
+df = pd.read_csv(args.cluster_assignments, sep="\t",
+                 usecols=["barcodes", "cluster_id"],
+                 dtype={"barcodes": str})
+df = df.set_index("barcodes")
+df["cluster_id"] = df["cluster_id"].astype("category")
 
-# Ensure correct ordering
-adata.obs['cluster_id'] = df.loc[adata.obs.index,"cluster_id"].astype("category").values
+# Ensure correct ordering (the categorical dtype is preserved)
+adata.obs['cluster_id'] = df["cluster_id"].reindex(adata.obs.index).values
 
 # Run neighbors
 L.info( "Using " + str(args.k) + " neighbors")
 
-sc.pp.neighbors(adata, n_neighbors = args.k, use_rep = 'X_pca')
+L.info("Using the " + args.knn_transformer + " knn")
 
+transformer = get_knn_transformer(args.knn_transformer, args.k,
+                                  args.umap_threads)
 
-print(ggplot_palette)
+if args.use_gpu and rapids_available():
+    L.info("Computing the neighbors on the GPU")
+    sc.pp.neighbors(adata, n_neighbors = args.k, use_rep = 'X_pca',
+                    method = 'rapids')
+elif transformer is None:
+    sc.pp.neighbors(adata, n_neighbors = args.k, use_rep = 'X_pca')
+else:
+    sc.pp.neighbors(adata, n_neighbors = args.k, use_rep = 'X_pca',
+                    transformer = transformer)
 
-# Run, plot and save umap
-sc.tl.umap(adata)
-sc.pl.umap(adata, color="cluster_id", legend_loc='on data',
-           save = ".png", show=False, palette=ggplot_palette)
 
-adata.obsm["X_umap_init_pre"] = adata.obsm["X_umap"]
+print(ggplot_palette)
 
-# Run and plot paga
+# Run and plot paga (only the neighbors graph is needed)
 sc.tl.paga(adata, groups='cluster_id')
 sc.pl.paga(adata, save=".png", show=False, cmap=ggplot_cmap)
 
-# Run, plot and store paga-initialised umap
-sc.tl.umap(adata, init_pos = sc.tl._utils.get_init_pos_from_paga(adata))
+# The paga initial positions are computed once and passed as a float32 array
+init_pos = sc.tl._utils.get_init_pos_from_paga(adata).astype(np.float32,
+                                                              copy=False)
+
+if args.emit_random_init_umap:
+    # Run the default umap first (the two layouts are run one after
+    # the other, each with umap_threads threads), keeping a single
+    # (local) handle on it
+    default_umap = run_umap(adata, "spectral", args.umap_threads)
+
+    # Plot the default umap
+    sc.pl.umap(adata, color="cluster_id", legend_loc='on data',
+               save = ".png", show=False, palette=ggplot_palette)
+
+run_umap(adata, init_pos, args.umap_threads)
+
+# Plot and store paga-initialised umap
+# (scanpy saves the figures at rcParams["savefig.dpi"])
+rcParams["savefig.dpi"] = args.final_dpi
 sc.pl.umap(adata, color="cluster_id", legend_loc='on data',
            save = ".paga.initialised.png", show=False,
            palette=ggplot_palette)
+rcParams["savefig.dpi"] = args.preview_dpi
 
 adata.obsm['X_umap_init_pos'] = adata.obsm['X_umap']
 
-# Rename X_umap_init_pos
-del adata.obsm['X_umap']
-adata.obsm['X_umap'] = adata.obsm['X_umap_init_pre']
-del adata.obsm['X_umap_init_pre']
+if args.emit_random_init_umap:
+    # Keep the default umap as X_umap
+    adata.obsm['X_umap'] = default_umap
+    del default_umap
 
 # Save paga-initialised UMAP coordinates
-umap_pos=pd.DataFrame(adata.obs['barcode'])
-umap_pos['x coordinate'] = pd.DataFrame(adata.obsm['X_umap_init_pos'][:,0]).values
-umap_pos['y coordinate'] = pd.DataFrame(adata.obsm['X_umap_init_pos'][:,1]).values
-
-out = args.outdir + '/UMAP_init_pos.csv'
-umap_pos.to_csv(out,index=False)
-
-# Write output file
-adata.write(results_file)
-
-# Compute and plot the force directed graph (FDG)
-sc.tl.draw_graph(adata)
-sc.pl.draw_graph(adata, color='cluster_id', legend_loc='on data',
-                 save=".png", show=False, palette=ggplot_palette)
+coords = adata.obsm['X_umap_init_pos']
+umap_pos = pd.DataFrame({'barcode': adata.obs['barcode'].to_numpy(),
+                         'x coordinate': coords[:, 0],
+                         'y coordinate': coords[:, 1]})
+
+feather.write_feather(umap_pos, args.outdir + '/UMAP_init_pos.feather')
+
+if args.legacy_tsv:
+    out = args.outdir + '/UMAP_init_pos.csv'
+    umap_pos.to_csv(out,index=False)
+
+# Write output file (X is an empty placeholder, only obs/obsm/obsp are stored)
+h5ad_compression = None if args.h5ad_compression == "none" else args.h5ad_compression
+adata.write(results_file, compression=h5ad_compression)
+
+# Compute and plot the force directed graph (FDG).
+# The ForceAtlas2 implementation used by scanpy is single threaded,
+# the igraph layouts (fr, drl) are much faster for large datasets.
+if args.emit_random_init_fdg:
+    sc.tl.draw_graph(adata, layout=args.fdg_layout)
+    sc.pl.draw_graph(adata, layout=args.fdg_layout, color='cluster_id',
+                     legend_loc='on data', save=".png", show=False,
+                     palette=ggplot_palette)
 
 # Compute and plot the PAGA initialised FDG
-sc.tl.draw_graph(adata, init_pos='paga')
-sc.pl.draw_graph(adata, color='cluster_id', legend_loc='on data',
-                 save=".paga.initialised.png", show=False, palette=ggplot_palette)
-
-
-paga_fa2 = pd.DataFrame(adata.obsm["X_draw_graph_fa"],
+sc.tl.draw_graph(adata, layout=args.fdg_layout, init_pos='paga')
+rcParams["savefig.dpi"] = args.final_dpi
+sc.pl.draw_graph(adata, layout=args.fdg_layout, color='cluster_id',
+                 legend_loc='on data', save=".paga.initialised.png",
+                 show=False, palette=ggplot_palette)
+rcParams["savefig.dpi"] = args.preview_dpi
+
+# (the table keeps its name and column names whatever the layout)
+paga_fa2 = pd.DataFrame(adata.obsm["X_draw_graph_" + args.fdg_layout],
                                     index=adata.obs['barcode'],
                                     columns=["FA1","FA2"])
 
-paga_fa2.to_csv(os.path.join(args.outdir, "paga_init_fa2.txt.gz"),
-                             sep="\t")
+feather.write_feather(paga_fa2.reset_index(),
+                      os.path.join(args.outdir, "paga_init_fa2.feather"))
+
+if args.legacy_tsv:
+    paga_fa2.to_csv(os.path.join(args.outdir, "paga_init_fa2.txt.gz"),
+                                 sep="\t")
 
 L.info("Complete")
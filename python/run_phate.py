@@ -26,6 +26,41 @@ logging.basicConfig(stream=sys.stdout, level=logging.DEBUG)
 L = logging.getLogger("run_paga")
 
 
+# ########################################################################### #
+# ########################### Functions ##################################### #
+# ########################################################################### #
+
+def approximate_affinity(data, k, decay=40, n_pca=100, threads=1):
+    '''Return a sparse PHATE (alpha-decay) affinity matrix computed from
+       the approximate k nearest neighbors found with pynndescent.
+
+       As in PHATE, data with more than n_pca features are first reduced
+       by PCA and the kernel bandwidth of each cell is the distance to
+       its k-th nearest neighbor.'''
+
+    from pynndescent import NNDescent
+    from sklearn.decomposition import PCA
+
+    data = np.asarray(data, dtype=np.float32)
+
+    if data.shape[1] > n_pca:
+        data = PCA(n_components=n_pca, svd_solver="randomized").fit_transform(data)
+
+    # the nearest neighbor of each cell is itself
+    index = NNDescent(data, n_neighbors=k + 1, n_jobs=threads, low_memory=False)
+    ind, dist = index.neighbor_graph
+
+    bandwidth = np.maximum(dist[:, k], np.finfo(np.float32).eps)
+    affinity = np.exp(-(dist / bandwidth[:, None]) ** decay)
+
+    n_cells = data.shape[0]
+    K = sparse.csr_matrix((affinity.ravel(), ind.ravel(),
+                           np.arange(0, n_cells * (k + 1) + 1, k + 1)),
+                          shape=(n_cells, n_cells))
+
+    return (K + K.T) / 2
+
+
 # ########################################################################### #
 # ######################## Parse the arguments ############################## #
 # ########################################################################### #
@@ -45,8 +80,17 @@ parser.add_argument("--cluster_colors", default=1, type=str,
                     help="tsv file with the color palette for the clusters")
 parser.add_argument("--k", default=5, type=int,
                     help="number of neighbors")
+parser.add_argument("--threads", default=1, type=int,
+                    help="number of threads")
+parser.add_argument("--knn_method", default="exact", type=str,
+                    choices=["exact", "pynndescent"],
+                    help="method used to find the nearest neighbors")
 parser.add_argument("--gif", default="No", type=str,
                     help="output a GIF")
+parser.add_argument("--emit_3d_plot", action="store_true",
+                    help="plot the 3D PHATE map")
+parser.add_argument("--legacy_tsv", action="store_true",
+                    help="also write the coordinates as gzipped tsv tables")
 
 
 args = parser.parse_args()
@@ -57,8 +101,9 @@ args = parser.parse_args()
 
 
 # Get the color palette
-ggplot_palette = [x for x in pd.read_csv(args.cluster_colors,
-                      header=None, sep="\t")[0].values]
+ggplot_palette = pd.read_csv(args.cluster_colors,
+                             header=None, sep="\t", usecols=[0],
+                             dtype=str)[0].tolist()
 
 ggplot_cmap = ListedColormap(sns.color_palette(ggplot_palette).as_hex())
 
@@ -79,13 +124,27 @@ if args.assay == "scaled.data":
     data = data.transpose()
 
 # Read and add cluster ids
-clusters = pd.read_csv(args.cluster_assignments,sep="\t")
+clusters = pd.read_csv(args.cluster_assignments, sep="\t",
+                       usecols=["cluster_id"])
+
+# the cluster ids are converted to an array once for all the plots
+cluster_ids = clusters["cluster_id"].to_numpy()
+
+barcodes = pd.read_csv(args.barcode_file, header=None)[0].to_numpy()
 
-phate_operator = phate.PHATE(n_jobs=-2, knn=args.k)
-x2 = phate_operator.fit_transform(data)
+if args.knn_method == "pynndescent":
+    # the approximate knn graph is built once and reused for the 3D embedding
+    phate_operator = phate.PHATE(n_jobs=args.threads, knn=args.k,
+                                 knn_dist="precomputed_affinity")
+    x2 = phate_operator.fit_transform(approximate_affinity(data, args.k,
+                                                           threads=args.threads))
+
+else:
+    phate_operator = phate.PHATE(n_jobs=args.threads, knn=args.k)
+    x2 = phate_operator.fit_transform(data)
 
 # save a 2D plot
-scprep.plot.scatter2d(x2, c=clusters["cluster_id"],
+scprep.plot.scatter2d(x2, c=cluster_ids,
                       figsize=(12,8), cmap=ggplot_cmap,
                       ticks=False, label_prefix="PHATE", s=15,
                       filename=os.path.join(args.outdir,"phate.2D.png"),
@@ -95,32 +154,40 @@ scprep.plot.scatter2d(x2, c=clusters["cluster_id"],
 rdims_phate = pd.DataFrame(x2,
                            columns=["PHATE1","PHATE2"])
 
-rdims_phate["barcode"] = pd.read_csv(args.barcode_file, header=None)[0].values
+rdims_phate["barcode"] = barcodes
+
+rdims_phate.to_feather(os.path.join(args.outdir,"phate.feather"))
 
-rdims_phate.to_csv(os.path.join(args.outdir,"phate.tsv.gz"),
-                   sep="\t")
+if args.legacy_tsv:
+    rdims_phate.to_csv(os.path.join(args.outdir,"phate.tsv.gz"),
+                       sep="\t")
 
-# save a 3D plot
+# compute the 3D embedding (and optionally save a 3D plot)
 phate_operator.set_params(n_components=3)
 x3 = phate_operator.transform()
-scprep.plot.scatter3d(x3, c=clusters["cluster_id"],
-                      figsize=(8,6), cmap=ggplot_cmap,
-                      ticks=False, label_prefix="PHATE",
-                      filename=os.path.join(args.outdir,"phate.3D.png"),
-                      dpi=300)
+
+if args.emit_3d_plot:
+    scprep.plot.scatter3d(x3, c=cluster_ids,
+                          figsize=(8,6), cmap=ggplot_cmap,
+                          ticks=False, label_prefix="PHATE",
+                          filename=os.path.join(args.outdir,"phate.3D.png"),
+                          dpi=300)
 
 # save the 3D coordinates
 rdims_phate = pd.DataFrame(x3,
                            columns=["PHATE1","PHATE2", "PHATE3"])
 
-rdims_phate["barcode"] = pd.read_csv(args.barcode_file, header=None)[0].values
+rdims_phate["barcode"] = barcodes
+
+rdims_phate.to_feather(os.path.join(args.outdir,"phate_3D.feather"))
 
-rdims_phate.to_csv(os.path.join(args.outdir,"phate_3D.tsv.gz"),
-                   sep="\t")
+if args.legacy_tsv:
+    rdims_phate.to_csv(os.path.join(args.outdir,"phate_3D.tsv.gz"),
+                       sep="\t")
 
 # save a GIF!
 if args.gif.lower() == "yes":
-    scprep.plot.rotate_scatter3d(x3, c=clusters["cluster_id"],
+    scprep.plot.rotate_scatter3d(x3, c=cluster_ids,
                                  figsize=(8,6), cmap=ggplot_cmap,
                                  ticks=False, label_prefix="PHATE",
                                  filename=os.path.join(args.outdir,"phate.3D.gif"),
@@ -91,7 +91,10 @@ adata.obs['cluster'] = clusters.loc[adata.obs.index,"cluster_id"].astype("catego
 # ################### Get rdims (e.g. umap) info  ########################### #
 # ########################################################################### #
 
-rdims = pd.read_csv(args.rdims, sep="\t")
+if args.rdims.endswith(".feather"):
+    rdims = pd.read_feather(args.rdims)
+else:
+    rdims = pd.read_csv(args.rdims, sep="\t")
 
 rdims.index = rdims["barcode"]
 
@@ -108,8 +111,8 @@ L.info("Rdims info added")
 scv.settings.figdir = args.outdir + "/"
 
 # Get the color palette
-ggplot_palette = [x for x in pd.read_csv(args.cluster_colors,
-                      header=None, sep="\t")[0].values]
+ggplot_palette = pd.read_csv(args.cluster_colors,
+                             header=None, sep="\t")[0].tolist()
 
 # preprocessing
 scv.pp.filter_and_normalize(rdata)